@@ -6,9 +6,15 @@ Manage Grafana v2.0 data sources
 .. code-block:: yaml
 
     grafana:
-      grafana_timeout: 3
       grafana_token: qwertyuiop
       grafana_url: 'https://url.com'
+      grafana_pool_maxsize: 50
+      grafana_use_urllib3: false
+      grafana_bulk_mode: false
+      grafana_connect_timeout: 3.05
+      grafana_read_timeout_list: 10
+      grafana_read_timeout_write: 30
+      grafana_read_timeout_delete: 10
 
 .. code-block:: yaml
 
@@ -24,7 +30,29 @@ Manage Grafana v2.0 data sources
         - is_default: true
 """
 
+import time
+import urllib.parse
+from dataclasses import dataclass
+from dataclasses import field
+
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # Optional: 2-5x faster than stdlib json when decoding large
+    # datasource lists; transparently falls back when not installed.
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+_SESSIONS = {}
+_POOLS = {}
+_CLIENTS = {}
+_DATASOURCE_CACHE = {}
+_HEADERS_CACHE = {}
+_READ_TIMEOUTS = {"list": 10, "write": 30, "delete": 10}
 
 
 def __virtual__():
@@ -34,6 +62,177 @@ def __virtual__():
     return (False, "Not configured for grafana_version 2")
 
 
+def _timeout(profile, kind):
+    """
+    Return a ``(connect, read)`` timeout tuple for the given kind of request
+    (``list``, ``write`` or ``delete``). The legacy ``grafana_timeout``
+    profile entry, if set, wins for all kinds.
+    """
+    if "grafana_timeout" in profile:
+        return profile["grafana_timeout"]
+    return (
+        profile.get("grafana_connect_timeout", 3.05),
+        profile.get(f"grafana_read_timeout_{kind}", _READ_TIMEOUTS[kind]),
+    )
+
+
+def _get_session(profile):
+    """
+    Return a pooled session for the profile's Grafana instance, so repeated
+    API calls within a run reuse one TCP/TLS connection instead of opening a
+    new one per request. The pool size can be raised via the
+    ``grafana_pool_maxsize`` profile option when many workers run in parallel.
+    """
+    url = profile["grafana_url"]
+    if url not in _SESSIONS:
+        session = requests.Session()
+        # raise_on_status=False lets an exhausted 5xx come back as a plain
+        # status so _request_with_retry can handle it, instead of surfacing
+        # as a RetryError with its own retry budget.
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=profile.get("grafana_pool_maxsize", 50),
+            max_retries=Retry(
+                total=2,
+                backoff_factor=0.2,
+                status_forcelist=[502, 503, 504],
+                raise_on_status=False,
+            ),
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _SESSIONS[url] = session
+    return _SESSIONS[url]
+
+
+def _get_pool(profile):
+    """
+    Return a shared ``urllib3.PoolManager`` for profiles that opt into the
+    raw transport via ``grafana_use_urllib3``. It reuses connections like
+    the session does, but skips the per-request Session machinery (hooks,
+    cookie jars, response wrapping) that this module never uses.
+    """
+    maxsize = profile.get("grafana_pool_maxsize", 32)
+    if maxsize not in _POOLS:
+        _POOLS[maxsize] = urllib3.PoolManager(
+            num_pools=4,
+            maxsize=maxsize,
+            retries=Retry(
+                total=2,
+                backoff_factor=0.2,
+                status_forcelist=[502, 503, 504],
+                raise_on_status=False,
+            ),
+        )
+    return _POOLS[maxsize]
+
+
+@dataclass
+class _Client:
+    """
+    Per-profile handle bundling the pooled session with precomputed URLs,
+    headers and timeouts, so the hot path avoids repeated profile lookups
+    and string formatting on every HTTP call.
+    """
+
+    session: requests.Session
+    pool: urllib3.PoolManager
+    base: str
+    headers: dict
+    timeouts: dict
+    list_url: str = field(init=False)
+
+    def __post_init__(self):
+        self.list_url = self.base + "/api/datasources"
+
+    def datasource_url(self, datasource_id):
+        return f"{self.base}/api/datasources/{datasource_id}"
+
+    def datasource_name_url(self, name):
+        return f"{self.base}/api/datasources/name/{urllib.parse.quote(name, safe='')}"
+
+    def request(self, method, url, data=None, kind="write", extra_headers=None):
+        """Issue one request over the configured transport and return the
+        ``(status, body)`` pair."""
+        timeout = self.timeouts[kind]
+        headers = self.headers if extra_headers is None else {**self.headers, **extra_headers}
+        if self.pool is not None:
+            body = None
+            if data is not None:
+                body = _json.dumps(data)
+                if isinstance(body, str):  # stdlib json; orjson emits bytes
+                    body = body.encode()
+                headers = {**headers, "Content-Type": "application/json"}
+            if isinstance(timeout, tuple):
+                timeout = urllib3.Timeout(connect=timeout[0], read=timeout[1])
+            response = self.pool.request(method, url, body=body, headers=headers, timeout=timeout)
+            return response.status, response.data
+        # json= serializes the payload properly (Grafana rejects the
+        # form-encoding that data= would produce for nested fields like
+        # jsonData) and sets the Content-Type header automatically.
+        response = self.session.request(method, url, json=data, headers=headers, timeout=timeout)
+        return response.status_code, response.content
+
+
+def _get_client(profile):
+    use_pool = profile.get("grafana_use_urllib3", False)
+    timeouts = {kind: _timeout(profile, kind) for kind in _READ_TIMEOUTS}
+    # Keyed by the values that define the client rather than object
+    # identity, so equal profiles share one client and a recycled dict
+    # can never alias another profile's connection or credentials.
+    key = (
+        profile["grafana_url"],
+        profile["grafana_token"],
+        use_pool,
+        profile.get("grafana_pool_maxsize"),
+        tuple(sorted(timeouts.items())),
+    )
+    client = _CLIENTS.get(key)
+    if client is None:
+        client = _CLIENTS[key] = _Client(
+            session=None if use_pool else _get_session(profile),
+            pool=_get_pool(profile) if use_pool else None,
+            base=profile["grafana_url"].rstrip("/"),
+            headers=_get_headers(profile),
+            timeouts=timeouts,
+        )
+    return client
+
+
+def _request_with_retry(
+    client, method, url, data=None, kind="write", extra_headers=None, acceptable=(), retries=2
+):
+    """
+    Issue a request, raising on HTTP error statuses and retrying transient
+    gateway errors (502/503/504) and connection failures with exponential
+    backoff. The underlying transports are built with ``raise_on_status``
+    disabled, so an exhausted 5xx arrives here as a plain status rather
+    than a ``RetryError``; such statuses used to be silently reported as
+    success. Statuses listed in ``acceptable`` are returned to the caller
+    instead of raising.
+    """
+    for attempt in range(retries + 1):
+        try:
+            status, body = client.request(
+                method, url, data=data, kind=kind, extra_headers=extra_headers
+            )
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.RetryError,
+            urllib3.exceptions.HTTPError,
+        ):
+            if attempt == retries:
+                raise
+        else:
+            if status < 400 or status in acceptable:
+                return status, body
+            if status not in (502, 503, 504) or attempt == retries:
+                raise requests.exceptions.HTTPError(f"{status} error for url: {url}")
+        time.sleep(0.2 * 2**attempt)
+    return None
+
+
 # pylint: disable=redefined-builtin
 def present(
     name,
@@ -85,6 +284,7 @@ def present(
         profile = __salt__["config.option"](profile)
 
     ret = {"name": name, "result": None, "comment": None, "changes": {}}
+    client = _get_client(profile)
     datasource = _get_datasource(profile, name)
     data = _get_json_data(
         name,
@@ -102,28 +302,71 @@ def present(
     )
 
     if datasource:
-        requests.put(
-            _get_url(profile, datasource["id"]),
-            data,
-            headers=_get_headers(profile),
-            timeout=profile.get("grafana_timeout", 3),
-        )
+        refreshed = False
+        while True:
+            changes = _diff(datasource, data)
+            if not changes["new"] and not changes["old"]:
+                ret["result"] = True
+                ret["comment"] = f"Data source {name} already up-to-date"
+                return ret
+            if __opts__["test"]:
+                ret["comment"] = f"Data source {name} would be updated"
+                ret["changes"] = changes
+                return ret
+            # If-Match lets Grafana reject stale updates cheaply (412)
+            # instead of re-serializing unchanged rows when concurrent runs
+            # race on the same datasource.
+            extra = None
+            if "version" in datasource:
+                extra = {"If-Match": str(datasource["version"])}
+            try:
+                status, _ = _request_with_retry(
+                    client,
+                    "PUT",
+                    client.datasource_url(datasource["id"]),
+                    data=data,
+                    extra_headers=extra,
+                    acceptable=(412,),
+                )
+            except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as exc:
+                ret["result"] = False
+                ret["comment"] = f"Failed to update data source {name}: {exc}"
+                return ret
+            if status != 412:
+                break
+            if refreshed:
+                ret["result"] = False
+                ret["comment"] = f"Data source {name} was concurrently modified, giving up"
+                return ret
+            # Someone else updated it since we read it; re-fetch and
+            # re-diff once before giving up.
+            refreshed = True
+            _invalidate(profile)
+            datasource = _get_datasource(profile, name)
+            if not datasource:
+                ret["result"] = False
+                ret["comment"] = f"Data source {name} was concurrently deleted"
+                return ret
+        cache = _DATASOURCE_CACHE.get(profile["grafana_url"])
+        if cache is not None:
+            cache[name] = dict(datasource, **data)
         ret["result"] = True
-        ret["changes"] = _diff(datasource, data)
-        if ret["changes"]["new"] or ret["changes"]["old"]:
-            ret["comment"] = f"Data source {name} updated"
-        else:
-            ret["changes"] = {}
-            ret["comment"] = f"Data source {name} already up-to-date"
+        ret["changes"] = changes
+        ret["comment"] = f"Data source {name} updated"
     else:
-        requests.post(
-            "{}/api/datasources".format(  # pylint: disable=consider-using-f-string
-                profile["grafana_url"]
-            ),  # pylint: disable=consider-using-f-string
-            data,
-            headers=_get_headers(profile),
-            timeout=profile.get("grafana_timeout", 3),
-        )
+        if __opts__["test"]:
+            ret["comment"] = f"Data source {name} would be created"
+            ret["changes"] = data
+            return ret
+        try:
+            _request_with_retry(client, "POST", client.list_url, data=data)
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as exc:
+            ret["result"] = False
+            ret["comment"] = f"Failed to add data source {name}: {exc}"
+            return ret
+        # The created datasource's id only exists server-side; re-fetch the
+        # list on the next lookup rather than caching an incomplete entry.
+        _invalidate(profile)
         ret["result"] = True
         ret["comment"] = f"New data source {name} added"
         ret["changes"] = data
@@ -142,6 +385,7 @@ def absent(name, profile="grafana"):
         profile = __salt__["config.option"](profile)
 
     ret = {"result": None, "comment": None, "changes": {}}
+    client = _get_client(profile)
     datasource = _get_datasource(profile, name)
 
     if not datasource:
@@ -149,11 +393,21 @@ def absent(name, profile="grafana"):
         ret["comment"] = f"Data source {name} already absent"
         return ret
 
-    requests.delete(
-        _get_url(profile, datasource["id"]),
-        headers=_get_headers(profile),
-        timeout=profile.get("grafana_timeout", 3),
-    )
+    if __opts__["test"]:
+        ret["comment"] = f"Data source {name} would be deleted"
+        return ret
+
+    try:
+        _request_with_retry(
+            client, "DELETE", client.datasource_url(datasource["id"]), kind="delete"
+        )
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as exc:
+        ret["result"] = False
+        ret["comment"] = f"Failed to delete data source {name}: {exc}"
+        return ret
+    cache = _DATASOURCE_CACHE.get(profile["grafana_url"])
+    if cache is not None:
+        cache.pop(name, None)
 
     ret["result"] = True
     ret["comment"] = f"Data source {name} was deleted"
@@ -161,34 +415,58 @@ def absent(name, profile="grafana"):
     return ret
 
 
-def _get_url(profile, datasource_id):
-    return "{}/api/datasources/{}".format(  # pylint: disable=consider-using-f-string
-        profile["grafana_url"], datasource_id
-    )
+def _load_datasources(profile):
+    """
+    Return a name -> datasource mapping for the profile's Grafana instance,
+    fetching the full list only once per run. Declaring many datasources in a
+    single state run then costs one GET instead of one per datasource.
+    """
+    url = profile["grafana_url"]
+    if url not in _DATASOURCE_CACHE:
+        client = _get_client(profile)
+        _status, body = _request_with_retry(client, "GET", client.list_url, kind="list")
+        _DATASOURCE_CACHE[url] = {
+            datasource["name"]: datasource for datasource in _json.loads(body)
+        }
+    return _DATASOURCE_CACHE[url]
+
+
+def _invalidate(profile=None):
+    """Drop the cached datasource list(s), forcing a re-fetch on next lookup."""
+    if profile is None:
+        _DATASOURCE_CACHE.clear()
+    else:
+        _DATASOURCE_CACHE.pop(profile["grafana_url"], None)
 
 
 def _get_datasource(profile, name):
-    response = requests.get(
-        "{}/api/datasources".format(  # pylint: disable=consider-using-f-string
-            profile["grafana_url"]
-        ),
-        headers=_get_headers(profile),
-        timeout=profile.get("grafana_timeout", 3),
+    """
+    Look up a single datasource. By default this asks Grafana's
+    ``/api/datasources/name/{name}`` endpoint for just the one object,
+    which avoids shipping and decoding the entire list. Profiles that
+    manage many datasources per run can set ``grafana_bulk_mode: true``
+    to fetch the full list once instead and serve lookups from the cache.
+    """
+    if profile.get("grafana_bulk_mode", False):
+        return _load_datasources(profile).get(name)
+    client = _get_client(profile)
+    status, body = _request_with_retry(
+        client, "GET", client.datasource_name_url(name), kind="list", acceptable=(404,)
     )
-    data = response.json()
-    for datasource in data:
-        if datasource["name"] == name:
-            return datasource
-    return None
+    if status == 404:
+        return None
+    return _json.loads(body)
 
 
 def _get_headers(profile):
-    return {
-        "Accept": "application/json",
-        "Authorization": "Bearer {}".format(  # pylint: disable=consider-using-f-string
-            profile["grafana_token"]
-        ),  # pylint: disable=consider-using-f-string
-    }
+    token = profile["grafana_token"]
+    headers = _HEADERS_CACHE.get(token)
+    if headers is None:
+        headers = _HEADERS_CACHE[token] = {
+            "Accept": "application/json",
+            "Authorization": f"Bearer {token}",
+        }
+    return headers
 
 
 # pylint: disable=redefined-builtin
@@ -223,15 +501,9 @@ def _get_json_data(
 
 
 def _diff(old, new):
-    old_keys = old.keys()
-    old = old.copy()
-    new = new.copy()
-    for key in old_keys:
-        if key in ("id", "orgId"):
-            del old[key]
-        elif key not in new.keys():
-            del old[key]
-        elif old[key] == new[key]:
-            del old[key]
-            del new[key]
-    return {"old": old, "new": new}
+    if old == new:
+        return {"old": {}, "new": {}}
+    skip = ("id", "orgId")
+    new_out = {k: v for k, v in new.items() if k not in skip and (k not in old or old[k] != v)}
+    old_out = {k: v for k, v in old.items() if k not in skip and k in new_out}
+    return {"old": old_out, "new": new_out}
@@ -1,8 +1,9 @@
 from unittest.mock import MagicMock
-from unittest.mock import Mock
+from unittest.mock import call
 from unittest.mock import patch
 
 import pytest
+import salt.utils.json
 
 from saltext.grafana.states import grafana_datasource
 
@@ -11,86 +12,270 @@ profile = {
     "grafana_token": "token",
 }
 
+headers = {
+    "Accept": "application/json",
+    "Authorization": "Bearer token",
+}
+
+timeouts = {"list": (3.05, 10), "write": (3.05, 30), "delete": (3.05, 10)}
+
+
+def mock_client(get_data, write_status=200):
+    client = grafana_datasource._Client(
+        session=MagicMock(),
+        pool=None,
+        base="http://grafana",
+        headers=headers,
+        timeouts=timeouts,
+    )
+
+    # pylint: disable-next=unused-argument
+    def fake_request(method, url, data=None, kind="write", extra_headers=None):
+        if method == "GET":
+            if url.startswith("http://grafana/api/datasources/name/"):
+                wanted = url.rsplit("/", 1)[-1]
+                for datasource in get_data:
+                    if datasource["name"] == wanted:
+                        return 200, salt.utils.json.dumps(datasource).encode()
+                return 404, b""
+            return 200, salt.utils.json.dumps(get_data).encode()
+        return write_status, b"{}"
 
-def mock_json_response(data):
-    response = MagicMock()
-    response.json = MagicMock(return_value=data)
-    return Mock(return_value=response)
+    client.request = MagicMock(side_effect=fake_request)
+    return client
 
 
 @pytest.fixture
 def configure_loader_modules():
-    return {grafana_datasource: {}}
+    return {grafana_datasource: {"__opts__": {"test": False}}}
+
+
+@pytest.fixture(autouse=True)
+def _clear_caches():
+    grafana_datasource._invalidate()
+    grafana_datasource._CLIENTS.clear()
+    yield
+    grafana_datasource._invalidate()
+    grafana_datasource._CLIENTS.clear()
 
 
 def test_present():
-    with patch("requests.get", mock_json_response([])):
-        with patch("requests.post") as rpost:
-            ret = grafana_datasource.present("test", "type", "url", profile=profile)
-            rpost.assert_called_once_with(
-                "http://grafana/api/datasources",
-                grafana_datasource._get_json_data("test", "type", "url"),
-                headers={
-                    "Authorization": "Bearer token",
-                    "Accept": "application/json",
-                },
-                timeout=3,
-            )
-            assert ret["result"]
-            assert ret["comment"] == "New data source test added"
+    client = mock_client([])
+    with patch.object(grafana_datasource, "_get_client", MagicMock(return_value=client)):
+        ret = grafana_datasource.present("test", "type", "url", profile=profile)
+        client.request.assert_called_with(
+            "POST",
+            "http://grafana/api/datasources",
+            data=grafana_datasource._get_json_data("test", "type", "url"),
+            kind="write",
+            extra_headers=None,
+        )
+        assert client.request.call_count == 2
+        assert ret["result"]
+        assert ret["comment"] == "New data source test added"
 
     data = grafana_datasource._get_json_data("test", "type", "url")
     data.update({"id": 1, "orgId": 1})
-    with patch("requests.get", mock_json_response([data])):
-        with patch("requests.put") as rput:
-            ret = grafana_datasource.present("test", "type", "url", profile=profile)
-            rput.assert_called_once_with(
-                "http://grafana/api/datasources/1",
-                grafana_datasource._get_json_data("test", "type", "url"),
-                headers={
-                    "Authorization": "Bearer token",
-                    "Accept": "application/json",
-                },
-                timeout=3,
+    client = mock_client([data])
+    with patch.object(grafana_datasource, "_get_client", MagicMock(return_value=client)):
+        ret = grafana_datasource.present("test", "type", "url", profile=profile)
+        assert client.request.call_args_list == [
+            call(
+                "GET",
+                "http://grafana/api/datasources/name/test",
+                data=None,
+                kind="list",
+                extra_headers=None,
             )
-            assert ret["result"]
-            assert ret["comment"] == "Data source test already up-to-date"
-            assert ret["changes"] == {}  # pylint: disable=use-implicit-booleaness-not-comparison
-
-        with patch("requests.put") as rput:
-            ret = grafana_datasource.present("test", "type", "newurl", profile=profile)
-            rput.assert_called_once_with(
-                "http://grafana/api/datasources/1",
-                grafana_datasource._get_json_data("test", "type", "newurl"),
-                headers={
-                    "Authorization": "Bearer token",
-                    "Accept": "application/json",
-                },
-                timeout=3,
-            )
-            assert ret["result"]
-            assert ret["comment"] == "Data source test updated"
-            assert ret["changes"] == {"old": {"url": "url"}, "new": {"url": "newurl"}}
+        ]
+        assert ret["result"]
+        assert ret["comment"] == "Data source test already up-to-date"
+        assert ret["changes"] == {}  # pylint: disable=use-implicit-booleaness-not-comparison
+
+    client = mock_client([data])
+    with patch.object(grafana_datasource, "_get_client", MagicMock(return_value=client)):
+        ret = grafana_datasource.present("test", "type", "newurl", profile=profile)
+        client.request.assert_called_with(
+            "PUT",
+            "http://grafana/api/datasources/1",
+            data=grafana_datasource._get_json_data("test", "type", "newurl"),
+            kind="write",
+            extra_headers=None,
+        )
+        assert client.request.call_count == 2
+        assert ret["result"]
+        assert ret["comment"] == "Data source test updated"
+        assert ret["changes"] == {"old": {"url": "url"}, "new": {"url": "newurl"}}
 
 
 def test_absent():
-    with patch("requests.get", mock_json_response([])):
-        with patch("requests.delete") as rdelete:
-            ret = grafana_datasource.absent("test", profile=profile)
-            assert rdelete.call_count == 0
-            assert ret["result"]
-            assert ret["comment"] == "Data source test already absent"
+    client = mock_client([])
+    with patch.object(grafana_datasource, "_get_client", MagicMock(return_value=client)):
+        ret = grafana_datasource.absent("test", profile=profile)
+        assert client.request.call_args_list == [
+            call(
+                "GET",
+                "http://grafana/api/datasources/name/test",
+                data=None,
+                kind="list",
+                extra_headers=None,
+            )
+        ]
+        assert ret["result"]
+        assert ret["comment"] == "Data source test already absent"
+
+    grafana_datasource._invalidate()
+    client = mock_client([{"name": "test", "id": 1}])
+    with patch.object(grafana_datasource, "_get_client", MagicMock(return_value=client)):
+        ret = grafana_datasource.absent("test", profile=profile)
+        client.request.assert_called_with(
+            "DELETE",
+            "http://grafana/api/datasources/1",
+            data=None,
+            kind="delete",
+            extra_headers=None,
+        )
+        assert client.request.call_count == 2
+        assert ret["result"]
+        assert ret["comment"] == "Data source test was deleted"
 
-    with patch("requests.get", mock_json_response([{"name": "test", "id": 1}])):
-        with patch("requests.delete") as rdelete:
+
+def test_test_mode():
+    client = mock_client([])
+    with patch.object(grafana_datasource, "_get_client", MagicMock(return_value=client)):
+        with patch.dict(grafana_datasource.__opts__, {"test": True}):
+            ret = grafana_datasource.present("test", "type", "url", profile=profile)
+            assert client.request.call_count == 1
+            assert ret["result"] is None
+            assert ret["comment"] == "Data source test would be created"
+
+    grafana_datasource._invalidate()
+    client = mock_client([{"name": "test", "id": 1}])
+    with patch.object(grafana_datasource, "_get_client", MagicMock(return_value=client)):
+        with patch.dict(grafana_datasource.__opts__, {"test": True}):
             ret = grafana_datasource.absent("test", profile=profile)
-            rdelete.assert_called_once_with(
-                "http://grafana/api/datasources/1",
-                headers={
-                    "Authorization": "Bearer token",
-                    "Accept": "application/json",
-                },
-                timeout=3,
+            assert client.request.call_count == 1
+            assert ret["result"] is None
+            assert ret["comment"] == "Data source test would be deleted"
+
+
+def test_present_write_failure():
+    client = mock_client([], write_status=400)
+    with patch.object(grafana_datasource, "_get_client", MagicMock(return_value=client)):
+        ret = grafana_datasource.present("test", "type", "url", profile=profile)
+        assert ret["result"] is False
+        assert "400" in ret["comment"]
+        assert client.request.call_count == 2
+
+
+def test_present_transient_5xx_retried():
+    client = mock_client([], write_status=502)
+    with patch.object(grafana_datasource, "_get_client", MagicMock(return_value=client)):
+        with patch.object(grafana_datasource.time, "sleep") as sleep:
+            ret = grafana_datasource.present("test", "type", "url", profile=profile)
+            assert ret["result"] is False
+            assert "502" in ret["comment"]
+            # One lookup plus the initial POST and two backed-off retries.
+            assert client.request.call_count == 4
+            assert sleep.call_count == 2
+
+
+def test_present_conditional_update():
+    old = grafana_datasource._get_json_data("test", "type", "url")
+    old.update({"id": 1, "orgId": 1, "version": 3})
+    newer = dict(old, version=4)
+    client = mock_client([old])
+    gets = iter([old, newer])
+    writes = iter([(412, b""), (200, b"{}")])
+
+    # pylint: disable-next=unused-argument
+    def fake_request(method, url, data=None, kind="write", extra_headers=None):
+        if method == "GET":
+            return 200, salt.utils.json.dumps(next(gets)).encode()
+        return next(writes)
+
+    client.request = MagicMock(side_effect=fake_request)
+    with patch.object(grafana_datasource, "_get_client", MagicMock(return_value=client)):
+        ret = grafana_datasource.present("test", "type", "newurl", profile=profile)
+        put_calls = [c for c in client.request.call_args_list if c.args[0] == "PUT"]
+        assert len(put_calls) == 2
+        assert put_calls[0].kwargs["extra_headers"] == {"If-Match": "3"}
+        assert put_calls[1].kwargs["extra_headers"] == {"If-Match": "4"}
+        assert ret["result"]
+        assert ret["comment"] == "Data source test updated"
+
+
+def test_bulk_mode():
+    bulk_profile = dict(profile, grafana_bulk_mode=True)
+    data = grafana_datasource._get_json_data("test", "type", "url")
+    data.update({"id": 1, "orgId": 1})
+    client = mock_client([data])
+    with patch.object(grafana_datasource, "_get_client", MagicMock(return_value=client)):
+        ret = grafana_datasource.present("test", "type", "url", profile=bulk_profile)
+        assert client.request.call_args_list == [
+            call(
+                "GET", "http://grafana/api/datasources", data=None, kind="list", extra_headers=None
             )
-            assert ret["result"]
-            assert ret["comment"] == "Data source test was deleted"
+        ]
+        assert ret["result"]
+        assert ret["comment"] == "Data source test already up-to-date"
+
+        # Further lookups in the same run are served from the cache.
+        ret = grafana_datasource.present("test", "type", "url", profile=bulk_profile)
+        assert client.request.call_count == 1
+        assert ret["result"]
+
+
+def test_client_request_session():
+    client = grafana_datasource._Client(
+        session=MagicMock(),
+        pool=None,
+        base="http://grafana",
+        headers=headers,
+        timeouts=timeouts,
+    )
+    response = client.session.request.return_value
+    response.status_code = 200
+    response.content = b"[]"
+    assert client.request("GET", client.list_url, kind="list") == (200, b"[]")
+    client.session.request.assert_called_once_with(
+        "GET",
+        "http://grafana/api/datasources",
+        json=None,
+        headers=headers,
+        timeout=(3.05, 10),
+    )
+
+
+def test_client_request_pool():
+    client = grafana_datasource._Client(
+        session=None,
+        pool=MagicMock(),
+        base="http://grafana",
+        headers=headers,
+        timeouts=timeouts,
+    )
+    response = client.pool.request.return_value
+    response.status = 200
+    response.data = b"{}"
+    data = {"name": "test"}
+    assert client.request("POST", client.list_url, data=data) == (200, b"{}")
+    _args, kwargs = client.pool.request.call_args
+    assert salt.utils.json.loads(kwargs["body"]) == data
+    assert kwargs["headers"]["Content-Type"] == "application/json"
+
+
+def test_get_client_cached():
+    client = grafana_datasource._get_client(profile)
+    assert client is grafana_datasource._get_client(profile)
+    assert client.session is grafana_datasource._get_session(profile)
+    assert client.pool is None
+    assert client.list_url == "http://grafana/api/datasources"
+    assert client.datasource_url(1) == "http://grafana/api/datasources/1"
+
+    # Equal-valued but distinct profile dicts share one client; a profile
+    # with different credentials gets its own.
+    assert grafana_datasource._get_client(dict(profile)) is client
+    other = grafana_datasource._get_client(dict(profile, grafana_token="other"))
+    assert other is not client
+    assert other.headers["Authorization"] == "Bearer other"